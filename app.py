@@ -1,18 +1,24 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from functools import wraps
 from datetime import datetime, timedelta
 from flask_cors import CORS
 import csv
-from time import time
+from math import ceil, isfinite
+from time import time, sleep
 import os
+import json
+import atexit
+import threading
+from collections import deque, OrderedDict
 import requests
 import io
 import base64
 import razorpay
 import psycopg2
 import psycopg2.extras
+import psycopg2.sql
 
 
 app = Flask(__name__)
@@ -44,10 +50,40 @@ CORS(
 SENDGRID_API_KEY = os.environ.get("SENDGRID_API_KEY")
 SENDGRID_FROM = os.environ.get("SENDGRID_FROM")
 SENDGRID_TO = os.environ.get("SENDGRID_TO", SENDGRID_FROM)
+# Override to point at a local stub server when testing
+SENDGRID_API_URL = os.environ.get("SENDGRID_API_URL", "https://api.sendgrid.com/v3/mail/send")
 
 RAZORPAY_KEY_ID = os.environ.get("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.environ.get("RAZORPAY_KEY_SECRET")
-razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+RAZORPAY_BASE_URL = os.environ.get("RAZORPAY_BASE_URL")
+if RAZORPAY_BASE_URL:
+    razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET), base_url=RAZORPAY_BASE_URL)
+else:
+    razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+RAZORPAY_WEBHOOK_SECRET = os.environ.get("RAZORPAY_WEBHOOK_SECRET")
+# Webhook status updates are written to orders in batches at this interval
+PAYMENT_FLUSH_SECONDS = float(os.environ.get("PAYMENT_FLUSH_SECONDS", 1))
+# How long to keep retrying an update whose order row has not been inserted yet,
+# and the longest gap between those retries
+PAYMENT_UPDATE_TTL_SECONDS = float(os.environ.get("PAYMENT_UPDATE_TTL_SECONDS", 900))
+PAYMENT_RETRY_MAX_SECONDS = float(os.environ.get("PAYMENT_RETRY_MAX_SECONDS", 60))
+
+# Total time budget for one request, shared by all outbound calls it makes.
+# Keep this below the gunicorn worker timeout (30 s by default).
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 20))
+
+# Admission control: total requests one worker process handles at a time, and
+# the share of that capacity each route class may use before it is shed.
+# Format: "class=share,..." e.g. "checkout=1.0,customer=0.8,admin=0.6,invoice=0.5"
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 8))
+ADMISSION_SHARES = os.environ.get("ADMISSION_SHARES", "checkout=1.0,customer=0.75,admin=0.5,invoice=0.5,contact=0.5")
+# Longest a request of each class may have waited in the server queue (measured
+# from the X-Request-Start header set by the router) before it is shed unrun
+ADMISSION_MAX_QUEUE_SECONDS = os.environ.get(
+    "ADMISSION_MAX_QUEUE_SECONDS", "checkout=15,customer=8,admin=5,invoice=5,contact=5"
+)
+# Above this average DB connect time, admin and invoice traffic is shed
+DB_SLOW_SECONDS = float(os.environ.get("DB_SLOW_SECONDS", 0.5))
 
 LAST_SENT = {}  # contact form spam protection
 ADMIN_DASHBOARD_KEY = os.environ.get("ADMIN_DASHBOARD_KEY", "MehtaMasalaAdmin2025")
@@ -55,13 +91,338 @@ ADMIN_DASHBOARD_KEY = os.environ.get("ADMIN_DASHBOARD_KEY", "MehtaMasalaAdmin202
 
 
 def get_db_connection():
-    return psycopg2.connect(
-        host=os.environ.get("DB_HOST"),
-        database=os.environ.get("DB_NAME"),
-        user=os.environ.get("DB_USER"),
-        password=os.environ.get("DB_PASSWORD"),
-        port=os.environ.get("DB_PORT")
-    )
+    started = time()
+    try:
+        return psycopg2.connect(
+            host=os.environ.get("DB_HOST"),
+            database=os.environ.get("DB_NAME"),
+            user=os.environ.get("DB_USER"),
+            password=os.environ.get("DB_PASSWORD"),
+            port=os.environ.get("DB_PORT")
+        )
+    finally:
+        ADMISSION.record_db_wait(time() - started)
+
+# ================================
+# OUTBOUND CALL RESILIENCE
+# ================================
+class UpstreamUnavailable(RuntimeError):
+    """
+    Raised instead of calling an upstream when its circuit is open, it is at
+    its concurrency limit, or the request deadline has no time left for it.
+    """
+
+    def __init__(self, name, reason, retry_after=5):
+        super().__init__(f"{name} unavailable: {reason}")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Per-upstream timeout, concurrency limit and circuit breaker.
+
+    closed    -> calls go through; the last `window` outcomes are tracked
+    open      -> calls fail fast until `reset_timeout` seconds have passed
+    half_open -> a single probe call is let through; success closes the
+                 circuit, failure opens it again
+    """
+
+    def __init__(self, name, timeout, max_concurrency=4, failure_threshold=0.5,
+                 min_calls=5, window=20, reset_timeout=30, ignore=()):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.ignore = ignore  # exceptions that are the caller's fault, not the upstream's
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._outcomes = deque(maxlen=window)  # True = success
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._in_flight = 0
+        self._rejected = 0
+
+    def _allow(self):
+        with self._lock:
+            if self._state == "open":
+                if time() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = "half_open"
+            if self._state == "half_open":
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def _record(self, success):
+        with self._lock:
+            if self._state == "half_open":
+                self._probe_in_flight = False
+                if success:
+                    self._state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_threshold):
+                self._trip()
+
+    def _trip(self):
+        self._state = "open"
+        self._opened_at = time()
+        self._outcomes.clear()
+
+    def _reject(self, reason, retry_after=1):
+        with self._lock:
+            self._rejected += 1
+        return UpstreamUnavailable(self.name, reason, retry_after)
+
+    def call(self, fn):
+        """
+        Run fn(timeout) under this breaker. The timeout passed to fn is the
+        upstream's own timeout, capped by what is left of the request deadline.
+        """
+        timeout = min(self.timeout, remaining_request_budget())
+        if timeout <= 0:
+            raise self._reject("request deadline exceeded")
+
+        if not self._slots.acquire(blocking=False):
+            raise self._reject("too many concurrent calls")
+        try:
+            if not self._allow():
+                retry_after = max(1, ceil(self.reset_timeout - (time() - self._opened_at)))
+                raise self._reject("circuit open", retry_after=retry_after)
+
+            with self._lock:
+                self._in_flight += 1
+            try:
+                result = fn(timeout)
+            except self.ignore:
+                self._record(True)
+                raise
+            except Exception:
+                self._record(False)
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+            self._record(True)
+            return result
+        finally:
+            self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            state = self._state
+            if state == "open" and time() - self._opened_at >= self.reset_timeout:
+                state = "half_open"
+            return {
+                "state": state,
+                "timeout": self.timeout,
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "recent_calls": len(self._outcomes),
+                "recent_failures": self._outcomes.count(False),
+                "rejected": self._rejected,
+            }
+
+
+def remaining_request_budget():
+    """Seconds left before the current request's deadline."""
+    if has_request_context() and "deadline" in g:
+        return g.deadline - time()
+    return REQUEST_DEADLINE_SECONDS
+
+
+def request_start_time():
+    """
+    When the request reached the front router, from X-Request-Start
+    ("t=<epoch>" or a bare epoch in s, ms or us). Falls back to now.
+    """
+    header = request.headers.get("X-Request-Start", "")
+    try:
+        started = float(header.replace("t=", "").strip())
+    except ValueError:
+        return time()
+    if not isfinite(started) or started <= 0:
+        return time()
+
+    if started > 1e14:  # us -> s
+        started /= 1e6
+    elif started > 1e11:  # ms -> s
+        started /= 1e3
+    return min(started, time())
+
+
+@app.before_request
+def set_request_deadline():
+    # Time spent queued in front of the worker counts against the deadline
+    g.request_start = request_start_time()
+    g.deadline = g.request_start + REQUEST_DEADLINE_SECONDS
+
+
+UPSTREAMS = {
+    "sendgrid": CircuitBreaker(
+        "sendgrid",
+        timeout=float(os.environ.get("SENDGRID_TIMEOUT", 5)),
+        max_concurrency=int(os.environ.get("SENDGRID_MAX_CONCURRENCY", 4)),
+    ),
+    "razorpay": CircuitBreaker(
+        "razorpay",
+        timeout=float(os.environ.get("RAZORPAY_TIMEOUT", 5)),
+        max_concurrency=int(os.environ.get("RAZORPAY_MAX_CONCURRENCY", 8)),
+        ignore=(razorpay.errors.BadRequestError,),
+    ),
+}
+
+
+def upstream_unavailable_response(e):
+    response = jsonify({"success": False, "error": str(e)})
+    response.headers["Retry-After"] = str(int(e.retry_after))
+    return response, 503
+
+
+# ================================
+# ADMISSION CONTROL
+# ================================
+# Lower number = higher priority. Checkout is shed last.
+ROUTE_CLASSES = {
+    "create_order": "checkout",
+    "create_razorpay_order": "checkout",
+    "verify_payment": "checkout",
+    "razorpay_webhook": "checkout",
+    "customer_orders": "customer",
+    "customer_order_details": "customer",
+    "customer_order_details_batch": "customer",
+    "admin_login": "admin",
+    "admin_orders": "admin",
+    "download_invoice": "invoice",
+    "send_message": "contact",
+}
+SHED_ON_SLOW_DB = ("admin", "invoice")
+
+
+def parse_route_class_values(value):
+    """Parse "class=number,..." into {class: float}."""
+    values = {}
+    for part in value.split(","):
+        if "=" in part:
+            name, number = part.split("=", 1)
+            values[name.strip()] = float(number)
+    return values
+
+
+class AdmissionController:
+    """
+    Tracks in-flight requests per route class and the average time spent
+    waiting for a DB connection, and sheds lower-priority classes first.
+
+    A class is admitted while total in-flight work is below its share of
+    `max_in_flight` and the request has not already waited longer than the
+    class's `max_queue_seconds` to reach a worker; when the DB is slow,
+    classes in `shed_on_slow_db` are rejected outright so checkout keeps the
+    connections it needs.
+    """
+
+    def __init__(self, max_in_flight, shares, max_queue_seconds=None,
+                 shed_on_slow_db=(), db_slow_seconds=0.5):
+        self.max_in_flight = max_in_flight
+        self.shares = shares
+        self.max_queue_seconds = max_queue_seconds or {}
+        self.shed_on_slow_db = shed_on_slow_db
+        self.db_slow_seconds = db_slow_seconds
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._shed = {}
+        self._db_wait = 0.0  # exponentially weighted moving average, seconds
+        self._db_wait_at = 0.0
+
+    def record_db_wait(self, seconds):
+        with self._lock:
+            self._db_wait = 0.8 * self._db_wait + 0.2 * seconds
+            self._db_wait_at = time()
+
+    def _db_is_slow(self):
+        # Shed classes stop sampling the DB, so forget a stale reading
+        # rather than shedding them forever after a single slow spell.
+        if time() - self._db_wait_at > 10:
+            self._db_wait = 0.0
+        return self._db_wait > self.db_slow_seconds
+
+    def try_enter(self, route_class, queued_seconds=0.0):
+        with self._lock:
+            total = sum(self._in_flight.values())
+            limit = self.max_in_flight * self.shares.get(route_class, 1.0)
+            max_queue = self.max_queue_seconds.get(route_class, REQUEST_DEADLINE_SECONDS)
+            if (total >= limit
+                    or queued_seconds > max_queue
+                    or (route_class in self.shed_on_slow_db and self._db_is_slow())):
+                self._shed[route_class] = self._shed.get(route_class, 0) + 1
+                return False
+            self._in_flight[route_class] = self._in_flight.get(route_class, 0) + 1
+            return True
+
+    def leave(self, route_class):
+        with self._lock:
+            self._in_flight[route_class] -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "shares": self.shares,
+                "max_queue_seconds": self.max_queue_seconds,
+                "in_flight": dict(self._in_flight),
+                "shed": dict(self._shed),
+                "db_wait_avg": round(self._db_wait, 4),
+                "db_slow": self._db_is_slow(),
+            }
+
+
+ADMISSION = AdmissionController(
+    ADMISSION_MAX_IN_FLIGHT,
+    parse_route_class_values(ADMISSION_SHARES),
+    max_queue_seconds=parse_route_class_values(ADMISSION_MAX_QUEUE_SECONDS),
+    shed_on_slow_db=SHED_ON_SLOW_DB,
+    db_slow_seconds=DB_SLOW_SECONDS,
+)
+
+
+@app.before_request
+def admit_request():
+    route_class = ROUTE_CLASSES.get(request.endpoint)
+    if not route_class:
+        return None
+
+    # Leave on the same controller that admitted it, even if ADMISSION is swapped
+    admission = ADMISSION
+    if not admission.try_enter(route_class, time() - g.request_start):
+        response = jsonify({"success": False, "error": "Server busy, please retry shortly"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+
+    g.admission = admission
+    g.route_class = route_class
+    return None
+
+
+@app.teardown_request
+def release_request(exc):
+    route_class = g.pop("route_class", None)
+    if route_class:
+        g.admission.leave(route_class)
+
 
 # ================================
 # HELPERS
@@ -102,12 +463,14 @@ def send_sendgrid_email(to_emails, subject, html_body, attachments=None):
         "Content-Type": "application/json"
     }
 
-    resp = requests.post(
-        "https://api.sendgrid.com/v3/mail/send",
-        json=payload,
-        headers=headers,
-        timeout=10
-    )
+    def post(timeout):
+        resp = requests.post(SENDGRID_API_URL, json=payload, headers=headers, timeout=timeout)
+        # Only server-side errors count against the breaker
+        if resp.status_code >= 500 or resp.status_code == 429:
+            raise RuntimeError(f"SendGrid error {resp.status_code}: {resp.text}")
+        return resp
+
+    resp = UPSTREAMS["sendgrid"].call(post)
 
     if resp.status_code not in (200, 202):
         raise RuntimeError(f"SendGrid error {resp.status_code}: {resp.text}")
@@ -274,7 +637,9 @@ def create_order():
 
     # Defaults
     payment_info.setdefault("method", "unknown")
-    payment_info.setdefault("status", "pending")
+    # Never trust a status sent by the client; verify-payment, the webhook and
+    # the reconcile job move it on from pending
+    payment_info["status"] = "pending"
     payment_info.setdefault("razorpay_order_id", None)
     payment_info.setdefault("razorpay_payment_id", None)
     payment_info.setdefault("razorpay_signature", None)
@@ -348,10 +713,272 @@ def verify_payment():
             "razorpay_payment_id": data["razorpay_payment_id"],
             "razorpay_signature": data["razorpay_signature"],
         })
+        PAYMENT_UPDATES.add(
+            f"verify:{data['razorpay_payment_id']}",
+            data["razorpay_order_id"],
+            data["razorpay_payment_id"],
+            "paid"
+        )
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 400
 
+# =====================================
+# RAZORPAY WEBHOOK + RECONCILIATION
+# =====================================
+# Razorpay payment status -> orders.payment_status
+RAZORPAY_PAYMENT_STATUS = {
+    "authorized": "authorized",
+    "captured": "paid",
+    "failed": "failed",
+}
+# A status only ever moves up this ranking, so late or replayed events for an
+# earlier payment attempt cannot downgrade an order
+PAYMENT_STATUS_RANK = {"failed": 1, "authorized": 2, "paid": 3}
+ORDER_STATUS_RANK_SQL = "CASE o.payment_status {} ELSE 0 END".format(
+    " ".join(f"WHEN '{status}' THEN {rank}" for status, rank in PAYMENT_STATUS_RANK.items())
+)
+
+
+class PaymentStatusUpdates:
+    """
+    Collects payment status updates and writes them to `orders` in batches,
+    one UPDATE ... FROM (VALUES ...) statement per flush.
+
+    Updates are keyed by Razorpay order ID so repeated events for one order
+    collapse into a single row, and event IDs already seen are dropped. The
+    UPDATE only moves an order up PAYMENT_STATUS_RANK, so replaying an event
+    (e.g. from another worker) is harmless. Payment usually completes before
+    create-order inserts the row, so updates that match no order are kept and
+    retried with exponential backoff (up to `max_backoff` seconds apart) for
+    `ttl` seconds.
+
+    The queue lives in this worker's memory only. It is flushed on a graceful
+    exit, but updates still queued when a worker is killed, or that outlive
+    their TTL, are lost; those orders stay 'pending' and are picked up by the
+    reconcile-payments job.
+    """
+
+    def __init__(self, flush_seconds=1.0, ttl=900, max_backoff=60, seen_limit=10000, background=True):
+        self.flush_seconds = flush_seconds
+        self.ttl = ttl
+        self.max_backoff = max_backoff
+        self.seen_limit = seen_limit
+        self.background = background  # False = caller flushes explicitly
+
+        self._lock = threading.Lock()
+        # razorpay_order_id -> {payment_id, status, queued_at, attempts, due_at}
+        self._pending = {}
+        self._seen = OrderedDict()
+        self._thread = None
+
+    def add(self, event_id, razorpay_order_id, payment_id, status):
+        if not razorpay_order_id or status not in PAYMENT_STATUS_RANK:
+            return False
+
+        with self._lock:
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = True
+            if len(self._seen) > self.seen_limit:
+                self._seen.popitem(last=False)
+
+            now = time()
+            self._merge(razorpay_order_id, {
+                "payment_id": payment_id,
+                "status": status,
+                "queued_at": now,
+                "attempts": 0,
+                "due_at": now,
+            })
+            if self.background:
+                self._start()
+        return True
+
+    def _merge(self, razorpay_order_id, update):
+        current = self._pending.get(razorpay_order_id)
+        if current is None:
+            self._pending[razorpay_order_id] = update
+            return
+        if PAYMENT_STATUS_RANK[update["status"]] >= PAYMENT_STATUS_RANK[current["status"]]:
+            current["payment_id"] = update["payment_id"]
+            current["status"] = update["status"]
+        # Keep the oldest timestamp so the TTL is not extended by retries
+        current["queued_at"] = min(current["queued_at"], update["queued_at"])
+        current["attempts"] = max(current["attempts"], update["attempts"])
+        current["due_at"] = min(current["due_at"], update["due_at"])
+
+    def _start(self):
+        # Started lazily so each gunicorn worker gets its own flusher
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self, force=False):
+        """Write the updates that are due (all of them if `force`)."""
+        now = time()
+        with self._lock:
+            batch = {
+                order_id: update for order_id, update in self._pending.items()
+                if force or update["due_at"] <= now
+            }
+            for order_id in batch:
+                del self._pending[order_id]
+        if not batch:
+            return 0
+
+        rows = [
+            (order_id, update["payment_id"], update["status"], PAYMENT_STATUS_RANK[update["status"]])
+            for order_id, update in batch.items()
+        ]
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            # Every existing order is matched and returned, but only changed
+            # when the new status ranks above its current one
+            matched = psycopg2.extras.execute_values(cur, f"""
+                UPDATE orders AS o
+                SET payment_status = CASE WHEN v.rank > {ORDER_STATUS_RANK_SQL}
+                                          THEN v.status ELSE o.payment_status END,
+                    razorpay_payment_id = CASE WHEN v.rank > {ORDER_STATUS_RANK_SQL}
+                                               THEN COALESCE(v.payment_id, o.razorpay_payment_id)
+                                               ELSE o.razorpay_payment_id END
+                FROM (VALUES %s) AS v(razorpay_order_id, payment_id, status, rank)
+                WHERE o.razorpay_order_id = v.razorpay_order_id
+                RETURNING o.razorpay_order_id
+            """, rows, page_size=500, fetch=True)
+            conn.commit()
+            cur.close()
+            conn.close()
+        except Exception as e:
+            print("Payment status flush error:", e)
+            # Put the batch back for the next flush, without clobbering newer updates
+            self._requeue(batch)
+            return 0
+
+        matched = {row[0] for row in matched}
+        self._requeue({
+            order_id: update for order_id, update in batch.items()
+            if order_id not in matched
+        })
+        return len(matched)
+
+    def _requeue(self, updates):
+        now = time()
+        with self._lock:
+            for order_id, update in updates.items():
+                if now - update["queued_at"] > self.ttl:
+                    print("Payment status update expired, order not found:", order_id)
+                    continue
+                update["attempts"] += 1
+                backoff = min(self.max_backoff, self.flush_seconds * 2 ** update["attempts"])
+                update["due_at"] = now + backoff
+                self._merge(order_id, update)
+
+
+PAYMENT_UPDATES = PaymentStatusUpdates(
+    flush_seconds=PAYMENT_FLUSH_SECONDS,
+    ttl=PAYMENT_UPDATE_TTL_SECONDS,
+    max_backoff=PAYMENT_RETRY_MAX_SECONDS,
+)
+# Write out whatever is still queued when a worker shuts down gracefully
+atexit.register(PAYMENT_UPDATES.flush, force=True)
+
+
+@app.post("/razorpay/webhook")
+def razorpay_webhook():
+    body = request.get_data(as_text=True)
+    signature = request.headers.get("X-Razorpay-Signature")
+
+    if not RAZORPAY_WEBHOOK_SECRET:
+        print("Razorpay webhook received but RAZORPAY_WEBHOOK_SECRET is not set")
+        return jsonify({"success": False, "error": "Webhook not configured"}), 500
+
+    if not signature:
+        return jsonify({"success": False, "error": "Missing signature"}), 400
+
+    try:
+        razorpay_client.utility.verify_webhook_signature(body, signature, RAZORPAY_WEBHOOK_SECRET)
+        event = json.loads(body)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    payment = ((event.get("payload") or {}).get("payment") or {}).get("entity") or {}
+    status = RAZORPAY_PAYMENT_STATUS.get(payment.get("status"))
+
+    # Razorpay sends a unique ID per event; fall back to payment ID + status
+    event_id = request.headers.get("X-Razorpay-Event-Id") or f"{payment.get('id')}:{payment.get('status')}"
+
+    queued = False
+    if status:
+        queued = PAYMENT_UPDATES.add(event_id, payment.get("order_id"), payment.get("id"), status)
+
+    # Always 200 once the signature checks out, otherwise Razorpay keeps retrying
+    return jsonify({"success": True, "queued": queued})
+
+
+@app.cli.command("reconcile-payments")
+def reconcile_payments():
+    """
+    Fetch Razorpay payments page by page for the window covering all pending
+    orders and apply their statuses. Run periodically from a scheduler:
+
+        flask --app app reconcile-payments
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT razorpay_order_id, EXTRACT(EPOCH FROM created_at)::bigint
+        FROM orders
+        WHERE payment_status = 'pending'
+          AND razorpay_order_id IS NOT NULL
+          AND created_at > NOW() - INTERVAL '7 days'
+    """)
+    pending = dict(cur.fetchall())
+    cur.close()
+    conn.close()
+
+    if not pending:
+        print("No pending orders")
+        return
+
+    # Give Razorpay's order a little slack before ours was written
+    since = min(pending.values()) - 3600
+    page_size = 100
+    skip = 0
+    matched = 0
+    updates = PaymentStatusUpdates(background=False)
+
+    while True:
+        page = UPSTREAMS["razorpay"].call(lambda timeout: razorpay_client.payment.all({
+            "from": since,
+            "count": page_size,
+            "skip": skip
+        }, timeout=timeout))
+        payments = page.get("items", [])
+
+        for payment in payments:
+            status = RAZORPAY_PAYMENT_STATUS.get(payment.get("status"))
+            if status and payment.get("order_id") in pending:
+                matched += updates.add(
+                    f"reconcile:{payment['id']}:{payment['status']}",
+                    payment["order_id"],
+                    payment["id"],
+                    status
+                )
+
+        if len(payments) < page_size:
+            break
+        skip += page_size
+
+    updated = updates.flush(force=True)
+    print(f"Pending orders: {len(pending)}, payments matched: {matched}, orders updated: {updated}")
+
 # ----------------------------
 # CONTACT FORM ROUTES (unchanged)
 # ----------------------------
@@ -406,6 +1033,8 @@ def send_message():
     try:
         send_sendgrid_email([SENDGRID_TO], f"New Contact – {subject}", html_body)
         return jsonify({"success": True})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -424,25 +1053,21 @@ def create_razorpay_order():
         # Razorpay works in paise → convert rupees to paise
         amount_paise = amount * 100
 
-        # Initialize Razorpay client
-        client = razorpay.Client(auth=(
-            os.getenv("RAZORPAY_KEY_ID"),
-            os.getenv("RAZORPAY_KEY_SECRET")
-        ))
-
-        order = client.order.create({
+        order = UPSTREAMS["razorpay"].call(lambda timeout: razorpay_client.order.create({
             "amount": amount_paise,
             "currency": "INR",
             "payment_capture": 1
-        })
+        }, timeout=timeout))
 
         return jsonify({
             "success": True,
             "order_id": order["id"],
             "amount": order["amount"],
-            "key": os.getenv("RAZORPAY_KEY_ID")
+            "key": RAZORPAY_KEY_ID
         })
 
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
         print("Razorpay Order Error:", e)
         return jsonify({"success": False, "error": str(e)}), 500
@@ -461,6 +1086,18 @@ def admin_required(fn):
         return fn(*args, **kwargs)
     return wrapper
 
+@app.get("/health/upstreams")
+@admin_required
+def upstream_health():
+    return jsonify({name: breaker.snapshot() for name, breaker in UPSTREAMS.items()})
+
+
+@app.get("/health/admission")
+@admin_required
+def admission_health():
+    return jsonify(ADMISSION.snapshot())
+
+
 @app.post("/admin/login")
 def admin_login():
     data = request.get_json() or {}
@@ -566,45 +1203,70 @@ def customer_orders():
         print("Customer order history error:", e)
         return jsonify({"success": False, "message": "Database error"}), 500
 
+# Order header + its items in one round trip
+ORDER_DETAILS_SQL = psycopg2.sql.SQL("""
+    SELECT o.order_id, o.created_at, o.customer_name, o.customer_city, o.customer_phone,
+           o.customer_address, o.customer_pincode, o.total_amount,
+           o.payment_status, o.payment_method, i.items
+    FROM orders o
+    LEFT JOIN LATERAL (
+        SELECT COALESCE(
+                   json_agg(json_build_object(
+                       'slug', slug, 'name', name, 'price', price,
+                       'weight', weight, 'quantity', quantity, 'image', image
+                   )),
+                   '[]'
+               ) AS items
+        FROM order_items
+        WHERE order_ref = o.id
+    ) i ON true
+    WHERE {where}
+    ORDER BY o.created_at DESC
+""")
+MAX_BATCH_ORDER_IDS = 100
+
+
+def fetch_order_details(where, params):
+    """`where` is a psycopg2.sql.Composable filtering `orders o`."""
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(ORDER_DETAILS_SQL.format(where=where), params)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+def order_details_json(row, include_address=True):
+    order = {
+        "order_id": row["order_id"],
+        "date": row["created_at"],
+        "name": row["customer_name"],
+        "city": row["customer_city"],
+        "phone": row["customer_phone"],
+        "total": row["total_amount"],
+        "payment_status": row["payment_status"],
+        "payment_method": row["payment_method"]
+    }
+    if include_address:
+        order["address"] = row["customer_address"]
+        order["pincode"] = row["customer_pincode"]
+    return order
+
+
 @app.get("/customer/order-details/<order_id>")
 def customer_order_details(order_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        rows = fetch_order_details(psycopg2.sql.SQL("o.order_id = %s"), (order_id,))
 
-        # Get order
-        cur.execute("SELECT * FROM orders WHERE order_id = %s", (order_id,))
-        order = cur.fetchone()
-
-        if not order:
+        if not rows:
             return jsonify({"success": False, "message": "Order not found"}), 404
 
-        # Get all items
-        cur.execute("""
-            SELECT slug, name, price, weight, quantity, image
-            FROM order_items WHERE order_ref = %s
-        """, (order["id"],))
-
-        items = cur.fetchall()
-
-        cur.close()
-        conn.close()
-
+        order = rows[0]
         return jsonify({
             "success": True,
-            "order": {
-                "order_id": order["order_id"],
-                "date": order["created_at"],
-                "name": order["customer_name"],
-                "city": order["customer_city"],
-                "phone": order["customer_phone"],
-                "address": order["customer_address"],
-                "pincode": order["customer_pincode"],
-                "total": order["total_amount"],
-                "payment_status": order["payment_status"],
-                "payment_method": order["payment_method"]
-            },
-            "items": [dict(i) for i in items]
+            "order": order_details_json(order),
+            "items": order["items"]
         })
 
     except Exception as e:
@@ -612,6 +1274,49 @@ def customer_order_details(order_id):
         return jsonify({"success": False, "message": "Database error"}), 500
 
 
+@app.post("/customer/order-details")
+def customer_order_details_batch():
+    """
+    Details + items for a customer's orders in one query. Takes the
+    customer's {"phone"} or {"email"}, optionally narrowed to
+    {"order_ids": [...]} of theirs. Like /customer/orders, addresses are
+    left out of the response.
+    """
+    data = request.get_json() or {}
+    order_ids = data.get("order_ids")
+    phone = data.get("phone")
+    email = data.get("email")
+
+    if phone:
+        conditions, params = [psycopg2.sql.SQL("o.customer_phone = %s")], [phone]
+    elif email:
+        conditions, params = [psycopg2.sql.SQL("o.customer_email = %s")], [email]
+    else:
+        return jsonify({"success": False, "message": "Phone or email required"}), 400
+
+    if order_ids is not None:
+        if not isinstance(order_ids, list) or not order_ids:
+            return jsonify({"success": False, "message": "order_ids must be a non-empty list"}), 400
+        if len(order_ids) > MAX_BATCH_ORDER_IDS:
+            return jsonify({"success": False, "message": f"At most {MAX_BATCH_ORDER_IDS} order_ids per request"}), 400
+        conditions.append(psycopg2.sql.SQL("o.order_id = ANY(%s)"))
+        params.append([str(o) for o in order_ids])
+
+    try:
+        rows = fetch_order_details(psycopg2.sql.SQL(" AND ").join(conditions), params)
+    except Exception as e:
+        print("Batch order details error:", e)
+        return jsonify({"success": False, "message": "Database error"}), 500
+
+    return jsonify({
+        "success": True,
+        "orders": [
+            {"order": order_details_json(row, include_address=False), "items": row["items"]}
+            for row in rows
+        ]
+    })
+
+
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
@@ -622,22 +1327,13 @@ from flask import send_file
 @app.get("/customer/invoice/<order_id>")
 def download_invoice(order_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        # Fetch order
-        cur.execute("SELECT * FROM orders WHERE order_id=%s", (order_id,))
-        order = cur.fetchone()
+        rows = fetch_order_details(psycopg2.sql.SQL("o.order_id = %s"), (order_id,))
 
-        if not order:
+        if not rows:
             return jsonify({"success": False, "message": "Order not found"}), 404
 
-        # Fetch items
-        cur.execute("SELECT * FROM order_items WHERE order_ref=%s", (order["id"],))
-        items = cur.fetchall()
-
-        cur.close()
-        conn.close()
+        order = rows[0]
+        items = order["items"]
     except Exception as e:
         print("Invoice Fetch Error:", e)
         return jsonify({"success": False, "message": "Database error"}), 500
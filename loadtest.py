@@ -0,0 +1,244 @@
+"""
+Load test for admission control: does checkout keep working under overload?
+
+Runs the app in-process on a threaded server with PostgreSQL replaced by a
+stub that has a fixed-size connection pool and a per-query delay, then drives
+mixed invoice / admin / checkout traffic from many client threads. The run is
+repeated with admission control effectively off and then with the configured
+limits, and reports checkout goodput next to how much invoice/admin traffic
+was shed.
+
+    python loadtest.py [--seconds 10] [--clients 96] [--db-delay 0.1]
+"""
+import argparse
+import logging
+import os
+import random
+import threading
+import warnings
+from collections import Counter
+from datetime import datetime, timedelta
+from time import time, sleep
+
+os.environ.setdefault("RAZORPAY_KEY_ID", "rzp_stub")
+os.environ.setdefault("RAZORPAY_KEY_SECRET", "stub")
+
+import jwt  # noqa: E402
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import app  # noqa: E402
+
+DB_POOL_SIZE = 4
+CLIENT_TIMEOUT = 3.0
+SHED_BACKOFF = 0.5
+# Share of client requests per route class
+TRAFFIC_MIX = [("invoice", 0.5), ("admin", 0.3), ("checkout", 0.2)]
+
+
+# ================================
+# STUB DATABASE
+# ================================
+class StubDatabase:
+    """A pool of DB_POOL_SIZE connections; every query takes `delay` seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.pool = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+    def connect(self, **kwargs):
+        self.pool.acquire()
+        return StubConnection(self)
+
+
+class StubConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+
+    def cursor(self, cursor_factory=None):
+        return StubCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.db.pool.release()
+
+
+class StubCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        sleep(self.db.delay)
+        sql = str(sql)  # psycopg2.sql.Composed reprs include their SQL text
+        if "RETURNING id" in sql:
+            self.rows = [(1,)]
+        elif "FROM orders o" in sql:
+            self.rows = [order_row()]
+        elif "FROM orders" in sql:
+            self.rows = [order_row() for _ in range(20)]
+        else:
+            self.rows = []
+        self.rowcount = len(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def order_row():
+    return {
+        "id": 1,
+        "order_id": "ORD12345678",
+        "created_at": datetime.now() - timedelta(days=1),
+        "customer_name": "Load Test",
+        "customer_city": "Ujjain",
+        "customer_phone": "9999999999",
+        "customer_address": "1 Test Street",
+        "customer_pincode": "456001",
+        "total_amount": 450,
+        "payment_status": "paid",
+        "payment_method": "razorpay",
+        "items": [
+            {"slug": "haldi", "name": "Haldi", "price": 150, "weight": 200, "quantity": 3, "image": None},
+        ],
+    }
+
+
+# ================================
+# CLIENTS
+# ================================
+def build_requests(base_url):
+    admin_token = jwt.encode(
+        {"admin_id": 1, "exp": datetime.utcnow() + timedelta(hours=1)},
+        app.SECRET_KEY,
+        algorithm="HS256"
+    )
+    checkout_body = {
+        "customer": {
+            "name": "Load Test", "phone": "9999999999", "email": "load@example.com",
+            "address": "1 Test Street", "city": "Ujjain", "pincode": "456001"
+        },
+        "cart": [{"slug": "haldi", "name": "Haldi", "price": 150, "weight": 200, "quantity": 3}],
+        "total": 450,
+    }
+    return {
+        "invoice": lambda s: s.get(f"{base_url}/customer/invoice/ORD12345678", timeout=CLIENT_TIMEOUT),
+        "admin": lambda s: s.get(f"{base_url}/admin/orders", headers={"Authorization": admin_token},
+                                 timeout=CLIENT_TIMEOUT),
+        "checkout": lambda s: s.post(f"{base_url}/create-order", json=checkout_body, timeout=CLIENT_TIMEOUT),
+    }
+
+
+def client_loop(calls, stop_at, results, lock):
+    session = requests.Session()
+    classes = [name for name, _ in TRAFFIC_MIX]
+    weights = [weight for _, weight in TRAFFIC_MIX]
+
+    while time() < stop_at:
+        route_class = random.choices(classes, weights)[0]
+        started = time()
+        try:
+            status = calls[route_class](session).status_code
+            outcome = {200: "ok", 503: "shed"}.get(status, f"http_{status}")
+        except requests.RequestException:
+            outcome = "timeout"
+        with lock:
+            results[route_class][outcome] += 1
+            if route_class == "checkout" and outcome == "ok":
+                results["checkout_latency"].append(time() - started)
+        if outcome == "shed":
+            sleep(SHED_BACKOFF)  # a client that honours Retry-After backs off
+
+
+def run(label, admission, seconds, clients, db_delay):
+    app.ADMISSION = admission
+    app.psycopg2.connect = StubDatabase(db_delay).connect
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    calls = build_requests(f"http://127.0.0.1:{server.server_port}")
+
+    results = {name: Counter() for name, _ in TRAFFIC_MIX}
+    results["checkout_latency"] = []
+    lock = threading.Lock()
+    stop_at = time() + seconds
+
+    threads = [
+        threading.Thread(target=client_loop, args=(calls, stop_at, results, lock))
+        for _ in range(clients)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Clients give up after CLIENT_TIMEOUT, but the server may still be working
+    # on their requests; let those finish before the next run swaps ADMISSION
+    drain_until = time() + 30
+    while sum(admission.snapshot()["in_flight"].values()) and time() < drain_until:
+        sleep(0.1)
+    server.shutdown()
+
+    report(label, results, seconds)
+    return results
+
+
+def report(label, results, seconds):
+    print(f"\n== {label} ==")
+    for name, _ in TRAFFIC_MIX:
+        counts = results[name]
+        total = sum(counts.values()) or 1
+        print(f"  {name:9s} requests={total:5d}  ok={counts['ok'] / total:6.1%}  "
+              f"shed={counts['shed'] / total:6.1%}  timeout={counts['timeout'] / total:6.1%}")
+
+    latencies = sorted(results["checkout_latency"])
+    goodput = len(latencies) / seconds
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else float("nan")
+    print(f"  checkout goodput={goodput:.1f}/s  p95={p95:.2f}s")
+
+
+def share(results, route_class, outcome):
+    counts = results[route_class]
+    return counts[outcome] / (sum(counts.values()) or 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=96)
+    parser.add_argument("--db-delay", type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    warnings.filterwarnings("ignore", module="jwt")
+
+    unlimited = app.AdmissionController(10 ** 6, {}, db_slow_seconds=float("inf"))
+    baseline = run("admission control off", unlimited, args.seconds, args.clients, args.db_delay)
+
+    limited = app.AdmissionController(
+        app.ADMISSION_MAX_IN_FLIGHT,
+        app.parse_route_class_values(app.ADMISSION_SHARES),
+        max_queue_seconds=app.parse_route_class_values(app.ADMISSION_MAX_QUEUE_SECONDS),
+        shed_on_slow_db=app.SHED_ON_SLOW_DB,
+        db_slow_seconds=app.DB_SLOW_SECONDS,
+    )
+    shedding = run("admission control on", limited, args.seconds, args.clients, args.db_delay)
+
+    print(f"\ninvoice shed:          {share(baseline, 'invoice', 'shed'):6.1%} -> "
+          f"{share(shedding, 'invoice', 'shed'):6.1%}")
+    print(f"checkout success rate: {share(baseline, 'checkout', 'ok'):6.1%} -> "
+          f"{share(shedding, 'checkout', 'ok'):6.1%}")
+    print(f"checkout goodput:      {len(baseline['checkout_latency']) / args.seconds:5.1f}/s -> "
+          f"{len(shedding['checkout_latency']) / args.seconds:5.1f}/s")
@@ -0,0 +1,336 @@
+"""
+Checks against a local stub server standing in for SendGrid and Razorpay.
+
+Circuit breakers: injects slow and 5xx responses and checks that calls time
+out, the circuit opens and fails fast with 503 + Retry-After, and a half-open
+probe closes it again once the stub recovers.
+
+Payments: posts signed webhooks (dedupe, bad signatures), flushes queued
+status updates into a stubbed DB connection, and runs reconcile-payments
+against a paged /v1/payments listing.
+
+    python stubtest.py
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time, sleep
+from urllib.parse import urlparse, parse_qs
+
+# What the stub does with the next request: "ok", "error" or "slow"
+MODE = {"value": "ok"}
+HITS = {"count": 0}
+# Served by GET /v1/payments, newest first like the real API
+PAYMENTS = [
+    {"id": f"pay_{n}", "order_id": f"order_{n}", "status": "captured"}
+    for n in range(250)
+]
+PAYMENT_PAGES = []  # skip of each GET /v1/payments
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/v1/payments":
+            return self.reply(404, b'{"error": "not stubbed"}')
+
+        query = parse_qs(url.query)
+        count = int(query.get("count", ["10"])[0])
+        skip = int(query.get("skip", ["0"])[0])
+        PAYMENT_PAGES.append(skip)
+        items = PAYMENTS[skip:skip + count]
+        self.reply(200, json.dumps({"entity": "collection", "count": len(items), "items": items}).encode())
+
+    def do_POST(self):
+        HITS["count"] += 1
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        if MODE["value"] == "slow":
+            sleep(2)
+        if MODE["value"] == "error":
+            status, body = 500, b'{"error": "injected"}'
+        elif self.path.startswith("/v1/orders"):
+            status, body = 200, b'{"id": "order_stub", "amount": 10000}'
+        else:
+            status, body = 202, b""
+
+        self.reply(status, body)
+
+    def reply(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except BrokenPipeError:
+            pass  # the client gave up on a slow response, as intended
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+stub_url = f"http://127.0.0.1:{server.server_port}"
+
+os.environ.update({
+    "SENDGRID_API_KEY": "stub",
+    "SENDGRID_FROM": "shop@example.com",
+    "SENDGRID_API_URL": f"{stub_url}/v3/mail/send",
+    "RAZORPAY_KEY_ID": "rzp_stub",
+    "RAZORPAY_KEY_SECRET": "stub",
+    "RAZORPAY_BASE_URL": stub_url,
+})
+
+import app  # noqa: E402  (must see the stub URLs above)
+
+RESET_TIMEOUT = 1
+
+
+def fresh_breaker(name, **kwargs):
+    breaker = app.CircuitBreaker(name, timeout=0.5, reset_timeout=RESET_TIMEOUT, **kwargs)
+    app.UPSTREAMS[name] = breaker
+    return breaker
+
+
+def send_email():
+    with app.app.test_request_context():
+        app.send_sendgrid_email(["customer@example.com"], "Test", "<p>hi</p>")
+
+
+def check_slow_upstream_times_out():
+    fresh_breaker("sendgrid")
+    MODE["value"] = "slow"
+    started = time()
+    try:
+        send_email()
+        raise AssertionError("slow upstream should have timed out")
+    except app.requests.Timeout:
+        pass
+    assert time() - started < 1.5, "timeout was not applied"
+
+
+def check_errors_open_circuit():
+    breaker = fresh_breaker("sendgrid")
+    MODE["value"] = "error"
+    for _ in range(breaker.min_calls):
+        try:
+            send_email()
+        except RuntimeError:
+            pass
+    assert breaker.snapshot()["state"] == "open"
+
+    # Open circuit: fails fast without touching the stub
+    hits = HITS["count"]
+    started = time()
+    try:
+        send_email()
+        raise AssertionError("open circuit should reject")
+    except app.UpstreamUnavailable:
+        pass
+    assert time() - started < 0.1
+    assert HITS["count"] == hits
+
+    client = app.app.test_client()
+    resp = client.post("/send-message", json={
+        "name": "A", "email": "a@example.com", "message": "hello"
+    })
+    assert resp.status_code == 503, resp.status_code
+    assert 1 <= int(resp.headers["Retry-After"]) <= RESET_TIMEOUT
+    assert HITS["count"] == hits
+
+
+def check_half_open_probe_closes_circuit():
+    breaker = app.UPSTREAMS["sendgrid"]
+    MODE["value"] = "ok"
+    sleep(RESET_TIMEOUT + 0.1)
+    assert breaker.snapshot()["state"] == "half_open"
+    send_email()
+    assert breaker.snapshot()["state"] == "closed"
+
+
+def check_razorpay_breaker():
+    breaker = fresh_breaker("razorpay", ignore=(app.razorpay.errors.BadRequestError,))
+    client = app.app.test_client()
+
+    MODE["value"] = "error"
+    for _ in range(breaker.min_calls):
+        resp = client.post("/create-razorpay-order", json={"amount": 100})
+        assert resp.status_code == 500, resp.status_code
+
+    resp = client.post("/create-razorpay-order", json={"amount": 100})
+    assert resp.status_code == 503, resp.status_code
+    assert "Retry-After" in resp.headers
+
+    MODE["value"] = "ok"
+    sleep(RESET_TIMEOUT + 0.1)
+    resp = client.post("/create-razorpay-order", json={"amount": 100})
+    assert resp.status_code == 200, resp.status_code
+    assert breaker.snapshot()["state"] == "closed"
+
+
+# ================================
+# PAYMENTS
+# ================================
+WEBHOOK_SECRET = "whsec_stub"
+
+
+class StubOrdersDB:
+    """
+    Stands in for psycopg2.connect: `statuses` maps razorpay_order_id to
+    payment_status, and the batched UPDATE is applied to it row by row.
+    """
+    encoding = "UTF8"
+
+    def __init__(self, statuses):
+        self.statuses = dict(statuses)
+        self.values_rows = []
+        self.connects = 0
+
+    def connect(self, **kwargs):
+        self.connects += 1
+        return self
+
+    def cursor(self, cursor_factory=None):
+        return StubOrdersCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubOrdersCursor:
+    def __init__(self, db):
+        self.connection = db
+        self.rows = []
+        self.page = []
+
+    def mogrify(self, template, args):
+        self.page.append(args)
+        return b"(%d)" % len(self.page)
+
+    def execute(self, sql, params=None):
+        sql = sql.decode() if isinstance(sql, bytes) else sql
+        db = self.connection
+        if "UPDATE orders" in sql:
+            db.values_rows.extend(self.page)
+            self.rows = []
+            for order_id, payment_id, status, rank in self.page:
+                if order_id not in db.statuses:
+                    continue
+                if rank > app.PAYMENT_STATUS_RANK.get(db.statuses[order_id], 0):
+                    db.statuses[order_id] = status
+                self.rows.append((order_id,))
+            self.page = []
+        elif "SELECT razorpay_order_id" in sql:
+            self.rows = [
+                (order_id, int(time()) - 600)
+                for order_id, status in db.statuses.items() if status == "pending"
+            ]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def post_webhook(client, event, event_id, secret=WEBHOOK_SECRET):
+    body = json.dumps(event)
+    signature = hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
+    return client.post("/razorpay/webhook", data=body, content_type="application/json", headers={
+        "X-Razorpay-Signature": signature,
+        "X-Razorpay-Event-Id": event_id,
+    })
+
+
+def captured_event(order_id, payment_id):
+    return {
+        "event": "payment.captured",
+        "payload": {"payment": {"entity": {"id": payment_id, "order_id": order_id, "status": "captured"}}},
+    }
+
+
+def check_webhook_dedupes_and_verifies():
+    client = app.app.test_client()
+    app.PAYMENT_UPDATES = app.PaymentStatusUpdates(background=False)
+
+    app.RAZORPAY_WEBHOOK_SECRET = None
+    resp = post_webhook(client, captured_event("order_w", "pay_w"), "evt_0")
+    assert resp.status_code == 500 and "not configured" in resp.json["error"], resp.json
+
+    app.RAZORPAY_WEBHOOK_SECRET = WEBHOOK_SECRET
+    first = post_webhook(client, captured_event("order_w", "pay_w"), "evt_1")
+    again = post_webhook(client, captured_event("order_w", "pay_w"), "evt_1")
+    assert first.status_code == again.status_code == 200
+    assert first.json["queued"] is True and again.json["queued"] is False
+    assert list(app.PAYMENT_UPDATES._pending) == ["order_w"]
+
+    forged = post_webhook(client, captured_event("order_x", "pay_x"), "evt_2", secret="wrong")
+    assert forged.status_code == 400, forged.status_code
+    assert "order_x" not in app.PAYMENT_UPDATES._pending
+
+
+def check_flush_batches_and_requeues():
+    db = StubOrdersDB({"order_a": "pending", "order_c": "authorized"})
+    app.psycopg2.connect = db.connect
+    updates = app.PaymentStatusUpdates(background=False, ttl=60)
+
+    updates.add("e1", "order_a", "pay_a", "paid")
+    updates.add("e2", "order_b", "pay_b", "paid")     # order not inserted yet
+    updates.add("e3", "order_c", "pay_c", "failed")   # would downgrade
+    assert updates.flush() == 2
+
+    assert sorted(db.values_rows) == [
+        ("order_a", "pay_a", "paid", 3),
+        ("order_b", "pay_b", "paid", 3),
+        ("order_c", "pay_c", "failed", 1),
+    ], db.values_rows
+    assert db.statuses == {"order_a": "paid", "order_c": "authorized"}
+
+    # Unmatched update is kept, but backs off instead of reconnecting every flush
+    assert list(updates._pending) == ["order_b"]
+    connects = db.connects
+    assert updates.flush() == 0
+    assert db.connects == connects
+
+    db.statuses["order_b"] = "pending"  # create-order lands
+    assert updates.flush(force=True) == 1
+    assert db.statuses["order_b"] == "paid" and not updates._pending
+
+
+def check_reconcile_pages_through_payments():
+    pending = {"order_5": "pending", "order_150": "pending", "order_240": "pending", "order_999": "pending"}
+    db = StubOrdersDB(pending)
+    app.psycopg2.connect = db.connect
+    PAYMENT_PAGES.clear()
+
+    result = app.app.test_cli_runner().invoke(args=["reconcile-payments"])
+    assert result.exit_code == 0, result.output
+
+    assert PAYMENT_PAGES == [0, 100, 200], PAYMENT_PAGES
+    assert db.statuses == {
+        "order_5": "paid", "order_150": "paid", "order_240": "paid", "order_999": "pending"
+    }, db.statuses
+    assert "orders updated: 3" in result.output, result.output
+
+
+if __name__ == "__main__":
+    for check in (
+        check_slow_upstream_times_out,
+        check_errors_open_circuit,
+        check_half_open_probe_closes_circuit,
+        check_razorpay_breaker,
+        check_webhook_dedupes_and_verifies,
+        check_flush_batches_and_requeues,
+        check_reconcile_pages_through_payments,
+    ):
+        check()
+        print("ok", check.__name__)
+    server.shutdown()